@@ -75,6 +75,11 @@ class DictProxy:
         dictproxy = self
 
         class Handler(StreamRequestHandler):
+            # Pipelined requests are pulled in with one recv() per 64 KiB.
+            # Writes stay unbuffered: every reply is a single sendall()
+            # and dovecot waits for it before it sends dependent requests.
+            rbufsize = 65536
+
             def handle(self):
                 try:
                     dictproxy.loop_forever(self.rfile, self.wfile)
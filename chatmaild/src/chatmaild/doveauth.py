@@ -1,7 +1,15 @@
+import functools
 import json
 import logging
+import multiprocessing
 import os
+import re
 import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
 
 try:
     import crypt_r
@@ -14,19 +22,22 @@ from .migrate_db import migrate_from_db_to_maildir
 
 NOCREATE_FILE = "/etc/chatmail-nocreate"
 
+USERDB_PREFIX = "shared/userdb/"
+PASSDB_PREFIX = "shared/passdb/"
 
-def encrypt_password(password: str):
+CRYPT_MAX_WORKERS = 4
+CRYPT_TIMEOUT = 30
+
+
+def encrypt_password(password: str) -> str:
     # https://doc.dovecot.org/configuration_manual/authentication/password_schemes/
+    # The output needs to stay SHA512-CRYPT so that dovecot can verify it.
     passhash = crypt_r.crypt(password, crypt_r.METHOD_SHA512)
     return "{SHA512-CRYPT}" + passhash
 
 
-def is_allowed_to_create(config: Config, user, cleartext_password) -> bool:
+def is_allowed_to_create(config: Config, user: str, cleartext_password: str) -> bool:
     """Return True if user and password are admissable."""
-    if os.path.exists(NOCREATE_FILE):
-        logging.warning(f"blocked account creation because {NOCREATE_FILE!r} exists.")
-        return False
-
     if len(cleartext_password) < config.password_min_length:
         logging.warning(
             "Password needs to be at least %s characters long",
@@ -36,7 +47,7 @@ def is_allowed_to_create(config: Config, user, cleartext_password) -> bool:
 
     parts = user.split("@")
     if len(parts) != 2:
-        logging.warning(f"user {user!r} is not a proper e-mail address")
+        logging.warning("user %r is not a proper e-mail address", user)
         return False
     localpart, domain = parts
 
@@ -56,97 +67,201 @@ def is_allowed_to_create(config: Config, user, cleartext_password) -> bool:
         )
         return False
 
+    # Check the file system last, most rejected requests
+    # are already caught by the string checks above.
+    if os.path.exists(NOCREATE_FILE):
+        logging.warning("blocked account creation because %r exists.", NOCREATE_FILE)
+        return False
+
     return True
 
 
-def split_and_unescape(s):
+_ESCAPE_OR_SEPARATOR_RE = re.compile(r'\\(.)|"', re.DOTALL)
+
+
+def split_and_unescape(s: str) -> list:
     """Split strings using double quote as a separator and backslash as escape character
-    into parts."""
-
-    out = ""
-    i = 0
-    while i < len(s):
-        c = s[i]
-        if c == "\\":
-            # Skip escape character.
-            i += 1
-
-            # This will raise IndexError if there is no character
-            # after escape character. This is expected
-            # as this is an invalid input.
-            out += s[i]
-        elif c == '"':
-            # Separator
-            yield out
-            out = ""
+    into a list of parts."""
+    if "\\" not in s:
+        return s.split('"')
+
+    parts = []
+    out = []
+    pos = 0
+    for m in _ESCAPE_OR_SEPARATOR_RE.finditer(s):
+        out.append(s[pos : m.start()])
+        if m.group(1) is not None:
+            # Drop the escape character, keep the escaped one.
+            out.append(m.group(1))
         else:
-            out += c
-        i += 1
-    yield out
+            # Separator
+            parts.append("".join(out))
+            out = []
+        pos = m.end()
+
+    rest = s[pos:]
+    if rest.endswith("\\"):
+        # There is no character after the escape character, invalid input.
+        raise ValueError(f"trailing escape character in {s!r}")
+    out.append(rest)
+    parts.append("".join(out))
+    return parts
+
+
+@functools.lru_cache(maxsize=4096)
+def _lookup_userdb_cached(config, addr, fileid):
+    # fileid changes whenever the password file is replaced or touched,
+    # so stale entries are never returned and simply age out of the cache.
+    return config.get_user(addr).get_userdb_dict()
+
+
+@functools.lru_cache(maxsize=4096)
+def _lookup_reply_cached(config, addr, fileid):
+    # Repeated logins, e.g. retries with a wrong password,
+    # reuse the encoded reply until the password file changes.
+    return f"O{json.dumps(_lookup_userdb_cached(config, addr, fileid))}\n"
+
+
+def _get_password_fileid(user):
+    try:
+        st = os.stat(user.password_path)
+    except FileNotFoundError:
+        return None
+    return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+
+def _make_crypt_pool(max_workers):
+    # use "spawn" because forking a process with running handler threads is unsafe
+    return ProcessPoolExecutor(
+        max_workers=max_workers, mp_context=multiprocessing.get_context("spawn")
+    )
 
 
 class AuthDictProxy(DictProxy):
-    def __init__(self, config):
+    def __init__(self, config, crypt_workers=0):
         super().__init__()
         self.config = config
+        # crypt_r holds the GIL while hashing,
+        # so hashing in worker processes lets account creations run in parallel.
+        self.crypt_workers = crypt_workers
+        self.crypt_pool = _make_crypt_pool(crypt_workers) if crypt_workers else None
+        self.crypt_timeout = CRYPT_TIMEOUT
+        self._crypt_pool_lock = threading.Lock()
+        self._domain_suffix = "@" + config.mail_domain
+        # (mtime_ns, addresses) of the last mailboxes directory scan
+        self._userdb_listing = (None, [])
 
     def handle_lookup(self, parts):
         # Dovecot <2.3.17 has only one part,
         # do not attempt to read any other parts for compatibility.
         keyname = parts[0]
 
-        namespace, type, args = keyname.split("/", 2)
-        args = list(split_and_unescape(args))
-
-        config = self.config
-        reply_command = "F"
-        res = ""
-        if namespace == "shared":
-            if type == "userdb":
-                user = args[0]
-                if user.endswith(f"@{config.mail_domain}"):
-                    res = self.lookup_userdb(user)
-                if res:
-                    reply_command = "O"
-                else:
-                    reply_command = "N"
-            elif type == "passdb":
-                user = args[1]
-                if user.endswith(f"@{config.mail_domain}"):
-                    res = self.lookup_passdb(user, cleartext_password=args[0])
-                if res:
-                    reply_command = "O"
-                else:
-                    reply_command = "N"
-        json_res = json.dumps(res) if res else ""
-        return f"{reply_command}{json_res}\n"
+        if keyname.startswith(USERDB_PREFIX):
+            args = split_and_unescape(keyname[len(USERDB_PREFIX) :])
+            addr = args[0]
+            if not addr.endswith(self._domain_suffix):
+                return "N\n"
+            user = self.config.get_user(addr)
+            fileid, userdata = self._lookup_userdb(user)
+        elif keyname.startswith(PASSDB_PREFIX):
+            args = split_and_unescape(keyname[len(PASSDB_PREFIX) :])
+            if len(args) < 2:
+                # password and address are separated by a double quote
+                return "F\n"
+            addr = args[1]
+            if not addr.endswith(self._domain_suffix):
+                return "N\n"
+            user = self.config.get_user(addr)
+            fileid, userdata = self._lookup_passdb(user, cleartext_password=args[0])
+        else:
+            return "F\n"
+
+        if not userdata:
+            return "N\n"
+        return _lookup_reply_cached(self.config, user.addr, fileid)
 
     def handle_iterate(self, parts):
         # example: I0\t0\tshared/userdb/
-        if parts[2] == "shared/userdb/":
-            result = "".join(
-                f"Oshared/userdb/{user}\t\n" for user in self.iter_userdb()
-            )
-            return f"{result}\n"
+        if parts[2] == USERDB_PREFIX:
+            addrs = self.iter_userdb()
+            if not addrs:
+                return "\n"
+            # one join over all addresses instead of formatting a line per user
+            prefix = "O" + USERDB_PREFIX
+            return prefix + ("\t\n" + prefix).join(addrs) + "\t\n\n"
 
     def iter_userdb(self) -> list:
         """Get a list of all user addresses."""
-        return [x for x in os.listdir(self.config.mailboxes_dir) if "@" in x]
+        mailboxes_dir = self.config.mailboxes_dir
+        # Creating or removing a mailbox changes the directory mtime.
+        mtime_ns = os.stat(mailboxes_dir).st_mtime_ns
+        cached_mtime_ns, addrs = self._userdb_listing
+        if mtime_ns == cached_mtime_ns:
+            return list(addrs)
+
+        # DirEntry.is_dir() uses the d_type from the directory listing
+        # and does not need an extra stat() call per entry.
+        with os.scandir(mailboxes_dir) as entries:
+            addrs = [e.name for e in entries if "@" in e.name and e.is_dir()]
+
+        # Changes within the timestamp granularity leave the mtime unchanged,
+        # so only reuse scans of directories that have not changed recently.
+        if time.time_ns() - mtime_ns > 1_000_000_000:
+            self._userdb_listing = (mtime_ns, addrs)
+        return list(addrs)
+
+    def encrypt_password(self, password):
+        crypt_pool = self.crypt_pool
+        if crypt_pool is None:
+            return encrypt_password(password)
+        try:
+            future = crypt_pool.submit(encrypt_password, password)
+            return future.result(timeout=self.crypt_timeout)
+        except BrokenProcessPool:
+            # A worker died (e.g. OOM killer), the pool can not be used anymore.
+            logging.error("password hashing worker died, restarting pool")
+        except FutureTimeoutError:
+            # Do not block the dovecot handler thread on a hung worker.
+            future.cancel()
+            logging.error("password hashing timed out, restarting pool")
+        with self._crypt_pool_lock:
+            if self.crypt_pool is crypt_pool:
+                self.crypt_pool = _make_crypt_pool(self.crypt_workers)
+                crypt_pool.shutdown(wait=False, cancel_futures=True)
+        return encrypt_password(password)
+
+    def shutdown(self):
+        if self.crypt_pool is not None:
+            self.crypt_pool.shutdown()
+
+    # The public lookups return copies, the cached dicts are shared
+    # by all requests and must not be modified.
 
     def lookup_userdb(self, addr):
-        return self.config.get_user(addr).get_userdb_dict()
+        fileid, userdata = self._lookup_userdb(self.config.get_user(addr))
+        return dict(userdata)
 
     def lookup_passdb(self, addr, cleartext_password):
         user = self.config.get_user(addr)
-        userdata = user.get_userdb_dict()
+        fileid, userdata = self._lookup_passdb(user, cleartext_password)
+        return dict(userdata)
+
+    def _lookup_userdb(self, user):
+        fileid = _get_password_fileid(user)
+        if fileid is None:
+            return None, {}
+        return fileid, _lookup_userdb_cached(self.config, user.addr, fileid)
+
+    def _lookup_passdb(self, user, cleartext_password):
+        fileid, userdata = self._lookup_userdb(user)
         if userdata:
-            return userdata
-        if not is_allowed_to_create(self.config, addr, cleartext_password):
-            return
+            return fileid, userdata
+        if not is_allowed_to_create(self.config, user.addr, cleartext_password):
+            return None, {}
 
-        user.set_password(encrypt_password(cleartext_password))
-        print(f"Created address: {addr}", file=sys.stderr)
-        return user.get_userdb_dict()
+        user.set_password(self.encrypt_password(cleartext_password))
+        print(f"Created address: {user.addr}", file=sys.stderr)
+        return self._lookup_userdb(user)
 
 
 def main():
@@ -155,6 +270,11 @@ def main():
 
     migrate_from_db_to_maildir(config)
 
-    dictproxy = AuthDictProxy(config=config)
-
-    dictproxy.serve_forever_from_socket(socket)
+    # Every worker is a separate interpreter, keep the pool small.
+    # Account creations are rare compared to lookups.
+    crypt_workers = min(CRYPT_MAX_WORKERS, os.cpu_count() or 1)
+    dictproxy = AuthDictProxy(config=config, crypt_workers=crypt_workers)
+    try:
+        dictproxy.serve_forever_from_socket(socket)
+    finally:
+        dictproxy.shutdown()
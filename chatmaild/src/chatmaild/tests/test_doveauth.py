@@ -1,5 +1,6 @@
 import io
 import json
+import os
 import queue
 import threading
 import traceback
@@ -9,7 +10,10 @@ import pytest
 import chatmaild.doveauth
 from chatmaild.doveauth import (
     AuthDictProxy,
+    crypt_r,
+    encrypt_password,
     is_allowed_to_create,
+    split_and_unescape,
 )
 from chatmaild.newemail import create_newemail_dict
 
@@ -28,6 +32,72 @@ def test_basic(dictproxy, gencreds):
     assert data == data2
 
 
+def test_encrypt_password():
+    passhashes = [encrypt_password(f"password{i}") for i in range(10)]
+    for i, passhash in enumerate(passhashes):
+        assert passhash.startswith("{SHA512-CRYPT}$6$")
+        salted = passhash.removeprefix("{SHA512-CRYPT}")
+        assert crypt_r.crypt(f"password{i}", salted) == salted
+
+
+def test_lookup_userdb_cached(dictproxy, gencreds):
+    addr, password = gencreds()
+    dictproxy.lookup_passdb(addr, password)
+    hits = chatmaild.doveauth._lookup_userdb_cached.cache_info().hits
+    data = dictproxy.lookup_userdb(addr)
+    assert data == dictproxy.lookup_userdb(addr)
+    assert chatmaild.doveauth._lookup_userdb_cached.cache_info().hits == hits + 2
+
+    data["password"] = "modified"
+    assert dictproxy.lookup_userdb(addr)["password"] != "modified"
+    assert dictproxy.lookup_passdb(addr, password)["password"] != "modified"
+
+    dictproxy.config.get_user(addr).set_password("{SHA512-CRYPT}newhash")
+    assert dictproxy.lookup_userdb(addr)["password"] == "{SHA512-CRYPT}newhash"
+
+
+def test_passdb_reply_cached(dictproxy):
+    msg = 'Lshared/passdb/kajdlkajsldk12l3kj1983"newuser12@chat.example.org'
+    res = dictproxy.handle_dovecot_request(msg, {})
+    assert res.startswith("O{")
+    wrong_msg = 'Lshared/passdb/kajdslqwe"newuser12@chat.example.org'
+    assert dictproxy.handle_dovecot_request(wrong_msg, {}) is res
+
+    dictproxy.config.get_user("newuser12@chat.example.org").set_password("xyz")
+    res2 = dictproxy.handle_dovecot_request(wrong_msg, {})
+    assert json.loads(res2[1:])["password"] == "xyz"
+
+
+@pytest.fixture
+def crypt_dictproxy(example_config):
+    dictproxy = AuthDictProxy(config=example_config, crypt_workers=1)
+    yield dictproxy
+    dictproxy.shutdown()
+
+
+def test_lookup_passdb_crypt_pool(crypt_dictproxy, gencreds):
+    addr, password = gencreds()
+    res = crypt_dictproxy.lookup_passdb(addr, password)
+    assert res["password"].startswith("{SHA512-CRYPT}")
+    assert crypt_dictproxy.lookup_userdb(addr) == res
+
+
+def test_lookup_passdb_crypt_worker_died(crypt_dictproxy, gencreds):
+    addr, password = gencreds()
+    assert crypt_dictproxy.lookup_passdb(addr, password)
+
+    crypt_pool = crypt_dictproxy.crypt_pool
+    for process in list(crypt_pool._processes.values()):
+        process.kill()
+        process.join()
+
+    for i in range(2):
+        addr, password = gencreds()
+        res = crypt_dictproxy.lookup_passdb(addr, password)
+        assert res["password"].startswith("{SHA512-CRYPT}")
+    assert crypt_dictproxy.crypt_pool is not crypt_pool
+
+
 def test_iterate_addresses(dictproxy):
     addresses = []
 
@@ -38,6 +108,55 @@ def test_iterate_addresses(dictproxy):
     res = dictproxy.iter_userdb()
     assert set(res) == set(addresses)
 
+    # stray files in the mailboxes directory are not users
+    dictproxy.config.mailboxes_dir.joinpath("x@chat.example.org.tmp").touch()
+    assert set(dictproxy.iter_userdb()) == set(addresses)
+
+
+def test_lookup_passdb_crypt_timeout(crypt_dictproxy, gencreds):
+    crypt_pool = crypt_dictproxy.crypt_pool
+    # starting the spawned worker alone takes longer than this
+    crypt_dictproxy.crypt_timeout = 0.000001
+    addr, password = gencreds()
+    res = crypt_dictproxy.lookup_passdb(addr, password)
+    assert res["password"].startswith("{SHA512-CRYPT}")
+    assert crypt_dictproxy.crypt_pool is not crypt_pool
+
+
+def test_iterate_addresses_cached(dictproxy, monkeypatch):
+    scans = []
+    scandir = os.scandir
+
+    def counting_scandir(path):
+        scans.append(path)
+        return scandir(path)
+
+    monkeypatch.setattr(chatmaild.doveauth.os, "scandir", counting_scandir)
+
+    mailboxes_dir = dictproxy.config.mailboxes_dir
+    addr1 = "asdf12340@chat.example.org"
+    addr2 = "asdf12341@chat.example.org"
+    dictproxy.lookup_passdb(addr1, "q9mr3faue")
+
+    # a directory with an old mtime is scanned once
+    os.utime(mailboxes_dir, (100000, 100000))
+    assert dictproxy.iter_userdb() == [addr1]
+    assert dictproxy.iter_userdb() == [addr1]
+    assert len(scans) == 1
+
+    # adding a mailbox changes the mtime and forces a rescan,
+    # the fresh mtime is not trusted for caching
+    dictproxy.lookup_passdb(addr2, "q9mr3faue")
+    assert set(dictproxy.iter_userdb()) == {addr1, addr2}
+    assert len(scans) == 2
+    assert set(dictproxy.iter_userdb()) == {addr1, addr2}
+    assert len(scans) == 3
+
+    os.utime(mailboxes_dir, (200000, 200000))
+    assert set(dictproxy.iter_userdb()) == {addr1, addr2}
+    assert set(dictproxy.iter_userdb()) == {addr1, addr2}
+    assert len(scans) == 4
+
 
 def test_invalid_username_length(example_config):
     config = example_config
@@ -72,6 +191,25 @@ def test_nocreate_file(monkeypatch, tmpdir, dictproxy):
     assert not dictproxy.lookup_userdb("newuser12@chat.example.org")
 
 
+@pytest.mark.parametrize(
+    ("s", "parts"),
+    [
+        ("", [""]),
+        ("user@example.org", ["user@example.org"]),
+        ('pass"user@example.org', ["pass", "user@example.org"]),
+        ('p\\\\a\\"s\\\'s"user@example.org', ["p\\a\"s's", "user@example.org"]),
+        ('\\\\"\\""', ["\\", '"', ""]),
+    ],
+)
+def test_split_and_unescape(s, parts):
+    assert split_and_unescape(s) == parts
+
+
+def test_split_and_unescape_trailing_escape():
+    with pytest.raises(ValueError):
+        split_and_unescape('pass"user\\')
+
+
 def test_handle_dovecot_request(dictproxy):
     transactions = {}
     # Test that password can contain ", ', \ and /
@@ -88,6 +226,15 @@ def test_handle_dovecot_request(dictproxy):
     assert userdata["password"].startswith("{SHA512-CRYPT}")
 
 
+def test_handle_dovecot_request_unknown_key(dictproxy):
+    assert dictproxy.handle_dovecot_request("Lshared/other/x", {}) == "F\n"
+    assert dictproxy.handle_dovecot_request("Lpriv/userdb/x", {}) == "F\n"
+    assert dictproxy.handle_dovecot_request("Lshared", {}) == "F\n"
+    assert dictproxy.handle_dovecot_request("Lshared/passdb/", {}) == "F\n"
+    msg = "Lshared/passdb/foo@chat.example.org"
+    assert dictproxy.handle_dovecot_request(msg, {}) == "F\n"
+
+
 def test_handle_dovecot_protocol_hello_is_skipped(example_config, caplog):
     dictproxy = AuthDictProxy(config=example_config)
     rfile = io.BytesIO(b"H3\t2\t0\t\tauth\n")
@@ -120,6 +267,14 @@ def test_handle_dovecot_protocol_iterate(gencreds, example_config):
     assert not lines[2]
 
 
+def test_handle_dovecot_protocol_iterate_empty(example_config):
+    dictproxy = AuthDictProxy(config=example_config)
+    rfile = io.BytesIO(b"H3\t2\t0\t\tauth\nI0\t0\tshared/userdb/")
+    wfile = io.BytesIO()
+    dictproxy.loop_forever(rfile, wfile)
+    assert wfile.getvalue() == b"\n"
+
+
 def test_50_concurrent_lookups_different_accounts(gencreds, dictproxy):
     num_threads = 50
     req_per_thread = 5
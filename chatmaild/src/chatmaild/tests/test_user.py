@@ -1,3 +1,6 @@
+from chatmaild.user import read_small_file
+
+
 def test_login_timestamp(testaddr, example_config):
     user = example_config.get_user(testaddr)
     user.set_password("someeqkjwelkqwjleqwe")
@@ -40,3 +43,11 @@ def test_no_mailboxes_dir(testaddr, example_config, tmp_path):
     user.set_password("someeqkjwelkqwjleqwe")
     user.set_last_login_timestamp(100000)
     assert user.get_last_login_timestamp() == 86400
+
+
+def test_read_small_file(tmp_path):
+    p = tmp_path.joinpath("password")
+    p.write_bytes(b"")
+    assert read_small_file(p) == b""
+    p.write_bytes(b"x" * 10000 + b"\n")
+    assert read_small_file(p, bufsize=512) == b"x" * 10000 + b"\n"
@@ -8,6 +8,19 @@ def get_daytimestamp(timestamp) -> int:
     return int(timestamp) // 86400 * 86400
 
 
+def read_small_file(path, bufsize=4096) -> bytes:
+    """Read a small file with plain os.open/os.read calls,
+    avoiding the overhead of opening a buffered text file object."""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        chunks = []
+        while chunk := os.read(fd, bufsize):
+            chunks.append(chunk)
+    finally:
+        os.close(fd)
+    return b"".join(chunks)
+
+
 class User:
     def __init__(self, maildir, addr, password_path, uid, gid):
         self.maildir = maildir
@@ -24,7 +37,7 @@ class User:
         """Return a non-empty dovecot 'userdb' style dict
         if the user has an existing non-empty password"""
         try:
-            pw = self.password_path.read_text()
+            pw = read_small_file(self.password_path).decode()
         except FileNotFoundError:
             return {}
 